@@ -1,9 +1,14 @@
-import json
 import logging
-from typing import Any, Dict, List, Optional
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Union
 
+import orjson
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
 from openpyxl.workbook import Workbook
 
@@ -28,24 +33,56 @@ class WBCategoriesParser:
     }
     EXCEL_FILENAME = "wb_categories_analysis.xlsx"
     JSON_FILENAME = "categories.json"
-
-    def __init__(self, headers: Optional[Dict[str, str]] = None):
-        """Initialize the parser with optional custom headers."""
+    EVIRMA_BATCH_SIZE = 500  # Keywords per Evirma request
+    EVIRMA_MAX_WORKERS = 4  # Concurrent Evirma requests
+    EXCEL_CHUNK_SIZE = 10_000  # Rows streamed into the worksheet per slice
+    REQUEST_TIMEOUT = (10, 60)  # (connect, read) seconds
+    RETRY_POLICY = Retry(
+        total=3,
+        backoff_factor=1,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None,  # Evirma lookups are POST but safe to repeat
+        respect_retry_after_header=True,
+    )
+    POOL_CONNECTIONS = 10  # Host pools kept by the adapter
+    POOL_MAXSIZE = 20  # Keep-alive connections per host (>= EVIRMA_MAX_WORKERS)
+
+    def __init__(
+        self,
+        headers: Optional[Dict[str, str]] = None,
+        session: Optional[requests.Session] = None,
+    ):
+        """Initialize the parser with optional custom headers and a shared session.
+
+        Passing a long-lived session lets repeated runs reuse pooled keep-alive
+        connections to Wildberries and Evirma instead of new TCP/TLS handshakes.
+        An injected session is used as is: headers are sent per request and the
+        pooled/retrying adapter is mounted only on a session created here.
+        """
         self.headers = headers or self.DEFAULT_HEADERS
-        self.session = requests.Session()
-        self.session.headers.update(self.headers)
+        self.debug = bool(os.getenv("WB_DEBUG"))  # Dump raw Evirma data to JSON_FILENAME
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(
+                pool_connections=self.POOL_CONNECTIONS,
+                pool_maxsize=self.POOL_MAXSIZE,
+                max_retries=self.RETRY_POLICY,
+            ))
+        self.session = session
 
     def fetch_data(self, url: str, method: str = "GET", **kwargs) -> Any:
         """Generic method to fetch data from API with error handling."""
         try:
             logger.info(f"Fetching data from {url}")
+            kwargs.setdefault("timeout", self.REQUEST_TIMEOUT)
+            kwargs.setdefault("headers", self.headers)
             response = self.session.request(method, url, **kwargs)
             response.raise_for_status()
-            return response.json()
+            return orjson.loads(response.content)
         except requests.exceptions.RequestException as e:
             logger.error(f"Request failed for {url}: {e}")
             raise
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(f"Failed to parse JSON response from {url}: {e}")
             raise
 
@@ -53,110 +90,109 @@ class WBCategoriesParser:
         """Fetch categories from Wildberries API."""
         return self.fetch_data(self.WB_CATEGORIES_URL)
 
-    def extract_category_hierarchy(self, categories: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """Extract category hierarchy with SEO keywords."""
-        result = []
-
-        def _process_category(
-            category: Dict[str, Any],
-            parent_name: Optional[str] = None,
-            root_name: Optional[str] = None,
-        ) -> None:
-            """Recursively process category and its children."""
-            current_name = category["name"]
-            current_seo = category.get("seo", "")
-            current_root = root_name or current_name
-
-            result.append({"SEO": current_seo})
-
-            for child in category.get("childs", []):
-                _process_category(child, current_name, current_root)
+    def extract_category_hierarchy(self, categories: List[Dict[str, Any]]) -> List[str]:
+        """Extract the SEO keyword of every category in the hierarchy (empty string if missing)."""
+        seo_list = []
+        # Iterative depth-first walk; children are pushed reversed to keep the original order
+        stack = list(reversed(categories))
+        while stack:
+            category = stack.pop()
+            seo_list.append(category.get("seo", ""))
+            stack.extend(reversed(category.get("childs", [])))
 
-        for category in categories:
-            _process_category(category)
-
-        return result
+        return seo_list
 
     def get_evirma_data(self, keywords: List[str]) -> Dict[str, Any]:
-        """Fetch keyword statistics from Evirma API."""
-        payload = {"keywords": keywords, "an": False}
-        data = self.fetch_data(self.EVIRMA_API_URL, method="POST", json=payload, timeout=30)
+        """Fetch keyword statistics from Evirma API in concurrent batches."""
+        batches = [
+            keywords[i:i + self.EVIRMA_BATCH_SIZE]
+            for i in range(0, len(keywords), self.EVIRMA_BATCH_SIZE)
+        ]
+        with ThreadPoolExecutor(max_workers=self.EVIRMA_MAX_WORKERS) as executor:
+            responses = list(executor.map(self._fetch_evirma_batch, batches))
 
         # Filter keywords with product_count > 0
         filtered_keywords = {
             keyword: stats
-            for keyword, stats in data.get("data", {}).get("keywords", {}).items()
+            for response in responses
+            for keyword, stats in response.get("data", {}).get("keywords", {}).items()
             if stats
             and isinstance(stats, dict)
             and (stats.get("product_count", 0) or 0) > 0
         }
-        data["data"]["keywords"] = filtered_keywords
+        data = {"data": {"keywords": filtered_keywords}}
 
-        self._save_json(data, self.JSON_FILENAME)
+        if self.debug:
+            self._save_json(data, self.JSON_FILENAME)
         return data
 
+    def _fetch_evirma_batch(self, keywords: List[str]) -> Dict[str, Any]:
+        """Fetch statistics for a single batch of keywords."""
+        payload = {"keywords": keywords, "an": False}
+        return self.fetch_data(self.EVIRMA_API_URL, method="POST", json=payload, timeout=30)
+
     def _save_json(self, data: Dict[str, Any], filename: str) -> None:
         """Save data to JSON file."""
         try:
-            with open(filename, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
+            with open(filename, "wb") as f:
+                f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
             logger.info(f"Data saved to {filename}")
         except IOError as e:
             logger.error(f"Failed to save JSON to {filename}: {e}")
             raise
 
     def merge_data(
-        self, categories: List[Dict[str, Any]], evirma_data: Dict[str, Any]
-    ) -> List[Dict[str, Any]]:
+        self, categories: List[str], evirma_data: Dict[str, Any]
+    ) -> pd.DataFrame:
         """Merge Wildberries categories with Evirma statistics."""
-        merged = []
         keywords_data = evirma_data.get("data", {}).get("keywords", {})
-
-        for keyword, stats in keywords_data.items():
-            if not isinstance(stats, dict):
-                continue
-
-            # Extract product count from different possible locations
-            product_count = (
-                stats.get("product_count", 0)
-                or stats.get("cluster", {}).get("product_count", 0)
-            )
-
-            # Extract frequency data
-            freq_data = stats.get("freq", {})
-            cluster_freq = stats.get("cluster", {}).get("freq_common", {})
-            
-            merged.append({
-                "Keyword": keyword,
-                "Product Count": product_count,
-                "Yearly Frequency": stats.get("freq365", 0) or cluster_freq.get("keyword_count", 0),
-                "Monthly Frequency": freq_data.get("monthly", 0) or cluster_freq.get("monthly", 0),
-                "Weekly Frequency": freq_data.get("weekly", 0) or cluster_freq.get("weekly", 0),
-                "Weekly Trend": freq_data.get("weekly_trend", 0) or cluster_freq.get("weekly_trend", 0),
-            })
-
-        return merged
-
-    def save_to_excel(self, data: List[Dict[str, Any]], filename: Optional[str] = None) -> None:
+        records = [
+            {"Keyword": keyword, **stats}
+            for keyword, stats in keywords_data.items()
+            if isinstance(stats, dict)
+        ]
+        # Flatten nested stats into dotted columns ("freq.monthly", "cluster.freq_common.monthly", ...)
+        df = pd.json_normalize(records)
+
+        def column(name: str) -> pd.Series:
+            if name not in df:
+                return pd.Series(0, index=df.index)
+            return df[name].fillna(0)
+
+        def first_nonzero(primary: str, fallback: str) -> pd.Series:
+            """Vectorized ``primary or fallback`` over two columns."""
+            values = column(primary)
+            return pd.to_numeric(values.where(values != 0, column(fallback)), downcast="integer")
+
+        return pd.DataFrame({
+            "Keyword": column("Keyword"),
+            "Product Count": first_nonzero("product_count", "cluster.product_count"),
+            "Yearly Frequency": first_nonzero("freq365", "cluster.freq_common.keyword_count"),
+            "Monthly Frequency": first_nonzero("freq.monthly", "cluster.freq_common.monthly"),
+            "Weekly Frequency": first_nonzero("freq.weekly", "cluster.freq_common.weekly"),
+            "Weekly Trend": first_nonzero("freq.weekly_trend", "cluster.freq_common.weekly_trend"),
+        })
+
+    def save_to_excel(
+        self, data: Union[pd.DataFrame, List[Dict[str, Any]]], filename: Optional[str] = None
+    ) -> None:
         """Save data to Excel with formatting."""
         filename = filename or self.EXCEL_FILENAME
         df = pd.DataFrame(data)
         df = df.sort_values(by=["Monthly Frequency"], ascending=False)
 
         try:
-            with pd.ExcelWriter(filename, engine="openpyxl") as writer:
-                df.to_excel(writer, index=False, sheet_name="Category Analysis")
-                self._format_excel(writer, df)
+            workbook = Workbook(write_only=True)
+            worksheet = workbook.create_sheet("Category Analysis")
+            self._write_sheet(worksheet, df)
+            workbook.save(filename)
             logger.info(f"Excel report saved to {filename}")
         except Exception as e:
             logger.error(f"Failed to save Excel file {filename}: {e}")
             raise
 
-    def _format_excel(self, writer: pd.ExcelWriter, df: pd.DataFrame) -> None:
-        """Apply formatting to Excel worksheet."""
-        workbook = writer.book
-        worksheet = writer.sheets["Category Analysis"]
-
+    def _write_sheet(self, worksheet: Any, df: pd.DataFrame) -> None:
+        """Stream formatted rows into a write-only worksheet."""
         # Column widths
         column_widths = {
             "A": 50,  # Keyword
@@ -170,14 +206,21 @@ class WBCategoriesParser:
         for col, width in column_widths.items():
             worksheet.column_dimensions[col].width = width
 
-        # Header formatting
+        # Style objects are shared by every cell instead of rebuilt per cell
         header_font = Font(bold=True)
-        header_alignment = Alignment(horizontal="center")
+        center_alignment = Alignment(horizontal="center")
+        thin_side = Side(style="thin")
+        border = Border(left=thin_side, right=thin_side, top=thin_side, bottom=thin_side)
 
-        for col in range(1, len(df.columns) + 1):
-            cell = worksheet.cell(row=1, column=col)
+        # Header formatting
+        header = []
+        for column in df.columns:
+            cell = WriteOnlyCell(worksheet, value=column)
             cell.font = header_font
-            cell.alignment = header_alignment
+            cell.alignment = center_alignment
+            cell.border = border  # pandas wrote the header with a thin border
+            header.append(cell)
+        worksheet.append(header)
 
         # Color coding
         colors = {
@@ -190,23 +233,25 @@ class WBCategoriesParser:
         high_cutoff = total_rows // 3
         medium_cutoff = 2 * (total_rows // 3)
 
-        for row in range(2, worksheet.max_row + 1):
-            if row <= high_cutoff + 1:
-                fill = colors["high"]
-            elif row <= medium_cutoff + 1:
-                fill = colors["medium"]
-            else:
-                fill = colors["low"]
-
-            for cell in worksheet[row]:
-                cell.fill = fill
-                cell.alignment = Alignment(horizontal="center")
-                cell.border = Border(
-                    left=Side(style="thin"),
-                    right=Side(style="thin"),
-                    top=Side(style="thin"),
-                    bottom=Side(style="thin"),
-                )
+        # Rows are streamed chunk by chunk so only one slice is boxed into Python objects at a time
+        for start in range(0, total_rows, self.EXCEL_CHUNK_SIZE):
+            chunk = df.iloc[start:start + self.EXCEL_CHUNK_SIZE]
+            for index, values in enumerate(chunk.itertuples(index=False, name=None), start):
+                if index < high_cutoff:
+                    fill = colors["high"]
+                elif index < medium_cutoff:
+                    fill = colors["medium"]
+                else:
+                    fill = colors["low"]
+
+                row = []
+                for value in values:
+                    cell = WriteOnlyCell(worksheet, value=value)
+                    cell.fill = fill
+                    cell.alignment = center_alignment
+                    cell.border = border
+                    row.append(cell)
+                worksheet.append(row)
 
     def run(self) -> bool:
         """Execute the full parsing pipeline."""
@@ -215,15 +260,16 @@ class WBCategoriesParser:
             
             # 1. Fetch and process categories
             categories = self.get_wb_categories()
-            category_hierarchy = self.extract_category_hierarchy(categories)
-            logger.info(f"Processed {len(category_hierarchy)} categories")
+            seo_list = self.extract_category_hierarchy(categories)
+            logger.info(f"Processed {len(seo_list)} categories")
 
             # 2. Get SEO keywords and fetch Evirma data
-            seo_keywords = [cat["SEO"] for cat in category_hierarchy if cat["SEO"]]
+            # Duplicate SEO strings are common across the tree; keep the first occurrence only
+            seo_keywords = list(dict.fromkeys(seo for seo in seo_list if seo))
             evirma_data = self.get_evirma_data(seo_keywords)
 
             # 3. Merge and save results
-            merged_data = self.merge_data(category_hierarchy, evirma_data)
+            merged_data = self.merge_data(seo_list, evirma_data)
             self.save_to_excel(merged_data)
 
             logger.info("Processing completed successfully")
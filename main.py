@@ -1,27 +1,33 @@
 import asyncio
 import logging
-import os
 import sys
 import re
-from typing import List, Union
 import time
 import datetime
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 from aiogram import Bot, Dispatcher, types
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.utils import executor
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from dotenv import load_dotenv
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+import aiofiles.os
+from pytz import timezone
 import requests
 
+from src.config.settings import settings  # Переменные окружения загружаются здесь один раз
+from src.services.rate_limiter import RateLimiter
 from wildberries import WildberriesEvirmaParser
 
-# Загрузка переменных окружения
-load_dotenv()
-
 # Настройка кодировки для Windows
 if sys.platform == "win32":
     import locale
-    locale.setlocale(locale.LC_ALL, 'ru_RU.UTF-8')
+    try:
+        locale.setlocale(locale.LC_ALL, 'ru_RU.UTF-8')
+    except locale.Error:
+        pass  # Локаль не установлена в системе — остаёмся на локали по умолчанию
 
 # Настройка логирования
 logging.basicConfig(
@@ -31,28 +37,48 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+MSK = timezone("Europe/Moscow")  # Часовой пояс дат в отчётах
+
+URL_PATTERN = re.compile(r'^https://www\.wildberries\.ru/catalog/[\w-]+/[\w-]+/[\w-]+$')
+
+WELCOME_TEXT = (
+    "🛍️ *Wildberries Categories Analyzer Bot*\n\n"
+    "Этот бот анализирует категории Wildberries и предоставляет статистику.\n\n"
+    "Доступные команды:\n"
+    "/parse - Запросить анализ категории\n"
+    "/list - Показать список админов (только для админов)"
+)
+
+class ParseStates(StatesGroup):
+    waiting_url = State()  # Пользователь должен прислать URL категории
+
 class BotConfig:
     def __init__(self):
-        self.token = os.getenv("TELEGRAM_BOT_TOKEN")
-        self.admin_ids = [int(id_) for id_ in os.getenv("ADMIN_ID").split(",")]  # Поддержка нескольких админов
+        self.token = settings.TELEGRAM_BOT_TOKEN
+        self.admin_ids = settings.ADMIN_IDS  # Множество для быстрых проверок доступа
+        self.admin_ids_list = settings.ADMIN_IDS_LIST  # Поддержка нескольких админов, без дубликатов
 
 class WBCategoriesBot:
     def __init__(self):
         self.config = BotConfig()
         self.bot = Bot(token=self.config.token)
-        self.dp = Dispatcher(self.bot)
+        self.dp = Dispatcher(self.bot, storage=MemoryStorage())
         self.parser = WildberriesEvirmaParser()
-        self.waiting_for_url = {}  # Словарь для отслеживания пользователей, ожидающих ввода URL
+        self.executor = ThreadPoolExecutor(max_workers=2)  # Пул для блокирующих вызовов парсера
+        self.rate_limiter = RateLimiter()  # Лимиты Telegram и повтор после RetryAfter
         self.log_messages = {}  # Словарь для хранения message_id и текста логов для каждого пользователя
 
-        # Регистрация обработчиков только для админов
-        self.dp.register_message_handler(self.start, commands=["start"], user_id=self.config.admin_ids)
-        self.dp.register_message_handler(self.list_admins, commands=["list"], user_id=self.config.admin_ids)
-        self.dp.register_message_handler(self.manual_parse, commands=["parse"], user_id=self.config.admin_ids)
-        self.dp.register_message_handler(self.handle_text, user_id=self.config.admin_ids)
+        # Регистрация обработчиков только для админов (команды и кнопки меню работают в любом состоянии)
+        self.dp.register_message_handler(self.start, commands=["start"], state="*", user_id=self.config.admin_ids)
+        self.dp.register_message_handler(self.list_admins, commands=["list"], state="*", user_id=self.config.admin_ids)
+        self.dp.register_message_handler(self.manual_parse, commands=["parse"], state="*", user_id=self.config.admin_ids)
+        self.dp.register_message_handler(self.manual_parse, text="Парсить", state="*", user_id=self.config.admin_ids)
+        self.dp.register_message_handler(self.list_admins, text="Список подписчиков", state="*", user_id=self.config.admin_ids)
+        self.dp.register_message_handler(self.cancel_url_input, text="Отмена", state=ParseStates.waiting_url, user_id=self.config.admin_ids)
+        self.dp.register_message_handler(self.handle_url, state=ParseStates.waiting_url, user_id=self.config.admin_ids)
         
-        # Обработчик для всех остальных сообщений от неадминов
-        self.dp.register_message_handler(self.unauthorized_access)
+        # Обработчик для всех сообщений от неадминов
+        self.dp.register_message_handler(self.unauthorized_access, lambda message: message.from_user.id not in self.config.admin_ids)
 
     async def unauthorized_access(self, message: types.Message):
         """Обработчик для неавторизованных пользователей"""
@@ -77,24 +103,16 @@ class WBCategoriesBot:
     async def start(self, message: types.Message):
         """Обработчик команды /start"""
         user_id = message.from_user.id
-        welcome_text = (
-            "🛍️ *Wildberries Categories Analyzer Bot*\n\n"
-            "Этот бот анализирует категории Wildberries и предоставляет статистику.\n\n"
-            "Доступные команды:\n"
-            "/parse - Запросить анализ категории\n"
-            "/list - Показать список админов (только для админов)"
-        )
-        await message.answer(welcome_text, parse_mode="Markdown", reply_markup=self.get_main_menu(user_id))
+        await message.answer(WELCOME_TEXT, parse_mode="Markdown", reply_markup=self.get_main_menu(user_id))
 
     async def list_admins(self, message: types.Message):
         """Показать список админов (только для админов)"""
-        admins = "\n".join([f"- {admin_id}" for admin_id in self.config.admin_ids])
+        admins = "\n".join(f"- {admin_id}" for admin_id in self.config.admin_ids_list)
         await message.answer(f"📋 Список админов:\n{admins}", reply_markup=self.get_main_menu(message.from_user.id))
 
     async def manual_parse(self, message: types.Message):
         """Ручной запрос парсинга"""
-        user_id = message.from_user.id
-        self.waiting_for_url[user_id] = 'manual'
+        await ParseStates.waiting_url.set()
         await message.answer(
             "🔗 Пожалуйста, отправьте URL категории Wildberries в формате:\n"
             "https://www.wildberries.ru/catalog/<category>/<subcategory>/<subsubcategory>\n"
@@ -103,63 +121,62 @@ class WBCategoriesBot:
             reply_markup=self.get_url_input_menu()
         )
 
-    async def handle_text(self, message: types.Message):
-        """Обработка текстовых сообщений"""
+    async def cancel_url_input(self, message: types.Message, state: FSMContext):
+        """Отмена ввода URL"""
+        await state.finish()
+        await message.answer(
+            "❌ Ввод URL отменён.",
+            parse_mode="Markdown",
+            reply_markup=self.get_main_menu(message.from_user.id)
+        )
+
+    async def handle_url(self, message: types.Message, state: FSMContext):
+        """Обработка ввода URL"""
         user_id = message.from_user.id
-        text = message.text.strip()
+        url = message.text.strip()
 
-        if text == "Парсить":
-            await self.manual_parse(message)
-            return
-        elif text == "Список подписчиков":
-            await self.list_admins(message)
+        # Проверка формата URL
+        if not URL_PATTERN.match(url):
+            await message.answer(
+                "❌ Ошибка: URL некорректен. Пожалуйста, используйте формат:\n"
+                "https://www.wildberries.ru/catalog/<category>/<subcategory>/<subsubcategory>\n"
+                "Например: https://www.wildberries.ru/catalog/dom-i-dacha/vannaya/aksessuary\n\n"
+                "Попробуйте снова или нажмите 'Отмена'.",
+                parse_mode="Markdown",
+                reply_markup=self.get_url_input_menu()
+            )
             return
-        elif text == "Отмена" and user_id in self.waiting_for_url:
-            del self.waiting_for_url[user_id]
+
+        await message.answer("🔄 Запускаю анализ категории...", reply_markup=self.get_url_input_menu())
+        success = await self.generate_and_send_report(user_id=user_id, category_url=url)
+        if success:
+            # Если парсинг успешен, выходим из режима ввода URL
+            await state.finish()
             await message.answer(
-                "❌ Ввод URL отменён.",
+                "✅ Парсинг завершён.",
                 parse_mode="Markdown",
                 reply_markup=self.get_main_menu(user_id)
             )
-            return
+        else:
+            # Если категория не найдена, продолжаем ожидать URL
+            await message.answer(
+                "❌ Ошибка: Категория не найдена или URL некорректен. Пожалуйста, используйте формат:\n"
+                "https://www.wildberries.ru/catalog/<category>/<subcategory>/<subsubcategory>\n"
+                "Например: https://www.wildberries.ru/catalog/dom-i-dacha/vannaya/aksessuary\n\n"
+                "Попробуйте снова или нажмите 'Отмена'.",
+                parse_mode="Markdown",
+                reply_markup=self.get_url_input_menu()
+            )
 
-        # Обработка ввода URL
-        if user_id in self.waiting_for_url:
-            url = text
-
-            # Проверка формата URL
-            url_pattern = r'^https://www\.wildberries\.ru/catalog/[\w-]+/[\w-]+/[\w-]+$'
-            if not re.match(url_pattern, url):
-                await message.answer(
-                    "❌ Ошибка: URL некорректен. Пожалуйста, используйте формат:\n"
-                    "https://www.wildberries.ru/catalog/<category>/<subcategory>/<subsubcategory>\n"
-                    "Например: https://www.wildberries.ru/catalog/dom-i-dacha/vannaya/aksessuary\n\n"
-                    "Попробуйте снова или нажмите 'Отмена'.",
-                    parse_mode="Markdown",
-                    reply_markup=self.get_url_input_menu()
-                )
-                return
-
-            await message.answer("🔄 Запускаю анализ категории...", reply_markup=self.get_url_input_menu())
-            success = await self.generate_and_send_report(user_id=user_id, category_url=url)
-            if success:
-                # Если парсинг успешен, выходим из режима ввода URL
-                del self.waiting_for_url[user_id]
-                await message.answer(
-                    "✅ Парсинг завершён.",
-                    parse_mode="Markdown",
-                    reply_markup=self.get_main_menu(user_id)
-                )
-            else:
-                # Если категория не найдена, продолжаем ожидать URL
-                await message.answer(
-                    "❌ Ошибка: Категория не найдена или URL некорректен. Пожалуйста, используйте формат:\n"
-                    "https://www.wildberries.ru/catalog/<category>/<subcategory>/<subsubcategory>\n"
-                    "Например: https://www.wildberries.ru/catalog/dom-i-dacha/vannaya/aksessuary\n\n"
-                    "Попробуйте снова или нажмите 'Отмена'.",
-                    parse_mode="Markdown",
-                    reply_markup=self.get_url_input_menu()
-                )
+    async def run_blocking(self, func, *args, **kwargs):
+        """
+        Выполнение блокирующего вызова парсера в пуле потоков, не останавливая event loop
+        
+        :param func: Синхронная функция
+        :return: Результат функции
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
 
     async def send_status(self, text: str, user_id: int, markdown: bool = False):
         """
@@ -170,11 +187,9 @@ class WBCategoriesBot:
         :param markdown: Использовать ли Markdown
         """
         logger.info(f"Sending status to user {user_id}: {text}")
+        parse_mode = "Markdown" if markdown or "*" in text or "_" in text else None
         try:
-            if markdown or ("*" in text or "_" in text):
-                await self.bot.send_message(user_id, text, parse_mode="Markdown")
-            else:
-                await self.bot.send_message(user_id, text)
+            await self.rate_limiter.call(user_id, self.bot.send_message, user_id, text, parse_mode=parse_mode)
         except Exception as e:
             logger.error(f"Failed to send status to user {user_id}: {e}")
 
@@ -187,7 +202,9 @@ class WBCategoriesBot:
         """
         if user_id not in self.log_messages:
             # Отправляем новое сообщение
-            message = await self.bot.send_message(user_id, f"📄 *Логи парсинга:*\n{log_message}", parse_mode="Markdown")
+            message = await self.rate_limiter.call(
+                user_id, self.bot.send_message, user_id, f"📄 *Логи парсинга:*\n{log_message}", parse_mode="Markdown"
+            )
             self.log_messages[user_id] = {'message_id': message.message_id, 'text': [log_message]}
         else:
             # Обновляем существующее сообщение
@@ -195,14 +212,16 @@ class WBCategoriesBot:
             current_logs.append(log_message)
             new_text = "📄 *Логи парсинга:*\n" + "\n".join(current_logs)
             try:
-                await self.bot.edit_message_text(
+                await self.rate_limiter.call(
+                    user_id,
+                    self.bot.edit_message_text,
                     chat_id=user_id,
                     message_id=self.log_messages[user_id]['message_id'],
                     text=new_text,
                     parse_mode="Markdown"
                 )
-                self.log_messages[user_id]['text'] = current_logs
             except Exception as e:
+                current_logs.remove(log_message)  # Убираем именно неотправленную строку: последней может быть строка другой страницы
                 logger.error(f"Failed to update log message for user {user_id}: {e}")
 
     async def clear_log_messages(self, user_id: int):
@@ -214,6 +233,20 @@ class WBCategoriesBot:
         if user_id in self.log_messages:
             del self.log_messages[user_id]
 
+    async def scrape_products(self, page: int, category: dict, user_id: int):
+        """
+        Парсинг одной страницы Wildberries
+        
+        :param page: Номер страницы
+        :param category: Данные категории
+        :param user_id: ID пользователя, которому отправляются логи
+        :return: Названия товаров на странице
+        """
+        # Темп запросов страниц задаёт _throttle парсера (общий для всех потоков)
+        wb_data, log_message = await self.run_blocking(self.parser.scrape_wb_page, page=page, category=category)
+        await self.update_log_message(user_id, log_message)
+        return self.parser.process_products(wb_data)
+
     async def generate_and_send_report(self, user_id: int, category_url: str) -> bool:
         """
         Генерация и отправка отчета
@@ -225,123 +258,77 @@ class WBCategoriesBot:
         logger.info(f"Generating report for user {user_id}, category: {category_url}")
         
         try:
-            # Статус: Начало работы
-            await self.send_status("🟢 *Начинаем анализ категории*", user_id=user_id, markdown=True)
+            # Все статусы собираются в одном сообщении с логами
+            await self.update_log_message(user_id, "🟢 *Начинаем анализ категории*")
 
             # Сбрасываем результаты парсера перед новой категорией
             self.parser.results = []
             
             # Модифицированный парсинг с отправкой логов
             start_time = time.time()
+            filename = None
+
+            async def finalize(summary: str):
+                """Сохранение и отправка отчёта — не больше одного раза за запуск"""
+                nonlocal filename
+                if not self.parser.results or filename is not None:
+                    return
+                filename = f"{category['name']}_analysis_{int(time.time())}"
+                await self.run_blocking(self.parser.save_to_excel, filename)
+                await self.update_log_message(user_id, f"{summary}. Сохранено {len(self.parser.results)} товаров")
+                await self.send_excel_to_user(filename, user_id)
+
             try:
-                category = self.parser.find_category_by_url(category_url)
+                category = await self.run_blocking(self.parser.find_category_by_url, category_url)
                 if not category:
                     return False
                 
-                for page in range(1, self.parser.MAX_PAGES + 1):
-                    wb_data, log_message = self.parser.scrape_wb_page(page=page, category=category)
-                    await self.update_log_message(user_id, log_message)
-                    
-                    products = self.parser.process_products(wb_data)
-                    if not products:
-                        await self.send_status(
-                            f"Страница {page}: товары не найдены, завершаем парсинг.",
-                            user_id=user_id,
-                            markdown=True
-                        )
-                        if self.parser.results:
-                            filename = f"{category['name']}_analysis_{int(time.time())}"
-                            self.parser.save_to_excel(filename)
-                            await self.send_excel_to_user(filename, user_id)
+                # Страницы запрашиваются параллельно, темп задаёт _throttle парсера
+                pages = await asyncio.gather(
+                    *(
+                        self.scrape_products(page, category, user_id)
+                        for page in range(1, self.parser.MAX_PAGES + 1)
+                    ),
+                    return_exceptions=True
+                )
+                keywords = []
+                page_error = None
+                for page, products in enumerate(pages, start=1):
+                    if isinstance(products, Exception):
+                        page_error = products
                         break
-                    
-                    evirma_response = self.parser.query_evirma_api(products)
-                    if evirma_response is None:
-                        if self.parser.results:
-                            filename = f"{category['name']}_analysis_{int(time.time())}"
-                            self.parser.save_to_excel(filename)
-                            await self.send_excel_to_user(filename, user_id)
-                        else:
-                            await self.send_status(
-                                "Товары не найдены по заданным критериям.",
-                                user_id=user_id,
-                                markdown=True
-                            )
+                    if not products:
+                        await self.update_log_message(user_id, f"Страница {page}: товары не найдены, завершаем парсинг.")
                         break
-                    
-                    page_results = self.parser.parse_evirma_response(evirma_response)
-                    self.parser.results.extend(page_results)
-                    
-                    await asyncio.sleep(1)
+                    keywords.extend(products)
+                
+                # Названия со всех страниц уходят в Evirma пачками, а не запросом на каждую страницу
+                self.parser.results.extend(await self.run_blocking(self.parser.query_evirma_batches, keywords))
+                if page_error:
+                    raise page_error
                 
                 if self.parser.results:
-                    filename = f"{category['name']}_analysis_{int(time.time())}"
-                    self.parser.save_to_excel(filename)
-                    await self.send_status(
-                        f"Парсинг завершён: товары закончились. Сохранено {len(self.parser.results)} товаров",
-                        user_id=user_id,
-                        markdown=True
-                    )
-                    await self.send_excel_to_user(filename, user_id)
+                    await finalize("Парсинг завершён: товары закончились")
                 else:
-                    await self.send_status(
-                        "Товары не найдены по заданным критериям.",
-                        user_id=user_id,
-                        markdown=True
-                    )
+                    await self.update_log_message(user_id, "Товары не найдены по заданным критериям.")
                 
                 return True
                 
             except requests.exceptions.HTTPError as e:
                 if e.response.status_code == 429:
-                    await self.send_status(
-                        "ℹ️ Максимум товаров спарсены.",
-                        user_id=user_id,
-                        markdown=True
-                    )
-                    if self.parser.results:
-                        filename = f"{category['name']}_analysis_{int(time.time())}"
-                        self.parser.save_to_excel(filename)
-                        await self.send_status(
-                            f"Парсинг завершён: максимум товаров спарсены. Сохранено {len(self.parser.results)} товаров",
-                            user_id=user_id,
-                            markdown=True
-                        )
-                        await self.send_excel_to_user(filename, user_id)
-                    return True
+                    await self.update_log_message(user_id, "ℹ️ Максимум товаров спарсены.")
+                    await finalize("Парсинг завершён: максимум товаров спарсены")
                 else:
-                    error_msg = f"❌ Ошибка во время парсинга: {str(e)}"
-                    await self.send_status(error_msg, user_id=user_id, markdown=True)
-                    if self.parser.results:
-                        filename = f"{category['name']}_analysis_{int(time.time())}"
-                        self.parser.save_to_excel(filename)
-                        await self.send_status(
-                            f"Парсинг завершён из-за ошибки. Сохранено {len(self.parser.results)} товаров",
-                            user_id=user_id,
-                            markdown=True
-                        )
-                        await self.send_excel_to_user(filename, user_id)
-                    return True
+                    await self.update_log_message(user_id, f"❌ Ошибка во время парсинга: {str(e)}")
+                    await finalize("Парсинг завершён из-за ошибки")
+                return True
             except Exception as e:
-                error_msg = f"❌ Ошибка во время парсинга: {str(e)}"
-                await self.send_status(error_msg, user_id=user_id, markdown=True)
-                if self.parser.results:
-                    filename = f"{category['name']}_analysis_{int(time.time())}"
-                    self.parser.save_to_excel(filename)
-                    await self.send_status(
-                        f"Парсинг завершён из-за ошибки. Сохранено {len(self.parser.results)} товаров",
-                        user_id=user_id,
-                        markdown=True
-                    )
-                    await self.send_excel_to_user(filename, user_id)
+                await self.update_log_message(user_id, f"❌ Ошибка во время парсинга: {str(e)}")
+                await finalize("Парсинг завершён из-за ошибки")
                 return True
             finally:
                 elapsed_time = time.time() - start_time
-                await self.send_status(
-                    f"Общее время работы: {elapsed_time:.2f} секунд",
-                    user_id=user_id,
-                    markdown=True
-                )
+                await self.update_log_message(user_id, f"Общее время работы: {elapsed_time:.2f} секунд")
 
         except Exception as e:
             error_msg = f"❌ *Ошибка при формировании отчета:*\n`{str(e)}`"
@@ -355,8 +342,8 @@ class WBCategoriesBot:
         """Удаление файла через 15 секунд"""
         await asyncio.sleep(15)
         try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            if await aiofiles.os.path.exists(file_path):
+                await aiofiles.os.remove(file_path)
                 logger.info(f"File deleted: {file_path}")
             else:
                 logger.warning(f"File not found for deletion: {file_path}")
@@ -373,47 +360,57 @@ class WBCategoriesBot:
         # Формируем полный путь к файлу в корневой директории
         file_path = f'{filename}.xlsx'
         
-        if not os.path.exists(file_path):
+        if not await aiofiles.os.path.exists(file_path):
             error_msg = f"❌ Файл отчета {file_path} не найден!"
             await self.send_status(error_msg, user_id=user_id, markdown=True)
             logger.error(error_msg)
             return
 
-        today = datetime.datetime.now().strftime("%d.%m.%Y")
+        today = datetime.datetime.now(MSK).strftime("%d.%m.%Y")
         caption = f"📊 *Анализ категории Wildberries* ({today})"
 
         try:
-            with open(file_path, "rb") as file:
-                await self.bot.send_document(
-                    user_id,
-                    types.InputFile(file, f'{filename}.xlsx'),
-                    caption=caption,
-                    parse_mode="Markdown"
-                )
+            # Файл передаётся по пути и выгружается частями, без чтения целиком в память;
+            # InputFile создаётся заново на каждую попытку, чтобы повтор после RetryAfter читал файл с начала
+            await self.rate_limiter.call(user_id, lambda: self.bot.send_document(
+                user_id,
+                types.InputFile(file_path),
+                caption=caption,
+                parse_mode="Markdown"
+            ))
             logger.info(f"Excel report sent to user {user_id}: {file_path}")
             # Запускаем задачу удаления файла через 15 секунд
             asyncio.create_task(self.delete_file_after_delay(file_path))
         except Exception as e:
             logger.error(f"Failed to send Excel to user {user_id}: {e}")
 
+    async def _notify_admin(self, admin_id: int):
+        """Уведомление админа о запуске бота"""
+        try:
+            await self.rate_limiter.call(
+                admin_id,
+                self.bot.send_message,
+                admin_id,
+                "🤖 *Бот запущен и готов к работе!*\n"
+                f"Ваш ID: {admin_id}\n"
+                "Используйте /start для начала работы.",
+                parse_mode="Markdown"
+            )
+        except Exception as e:
+            logger.error(f"Failed to notify admin {admin_id}: {e}")
+
     async def on_startup(self, _):
         logger.info("Bot starting up...")
-        # Уведомление админов
-        for admin_id in self.config.admin_ids:
-            try:
-                await self.bot.send_message(
-                    admin_id,
-                    "🤖 *Бот запущен и готов к работе!*\n"
-                    f"Ваш ID: {admin_id}\n"
-                    "Используйте /start для начала работы.",
-                    parse_mode="Markdown"
-                )
-            except Exception as e:
-                logger.error(f"Failed to notify admin {admin_id}: {e}")
+        # Уведомление админов (параллельно)
+        await asyncio.gather(
+            *(self._notify_admin(admin_id) for admin_id in self.config.admin_ids_list),
+            return_exceptions=True
+        )
 
     async def on_shutdown(self, _):
         """Действия при остановке бота"""
         logger.info("Bot shutting down...")
+        self.executor.shutdown(wait=False)
         await self.bot.close()
 
     def run(self):
@@ -1,22 +1,39 @@
 from aiogram import types, Dispatcher
+from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 import re
 from src.config.settings import settings
 
+URL_PATTERN = re.compile(r'^https://www\.wildberries\.ru/catalog/[\w-]+/[\w-]+/[\w-]+$')
+
+WELCOME_TEXT = (
+    "🛍️ *Wilberries Parser Frequency Bot*\n\n"
+    "Этот бот анализирует категории Wildberries и предоставляет статистику частоты поиска товаров.\n\n"
+    "Доступные команды:\n"
+    "/parse - Запросить анализ категории\n"
+    "/list - Показать список админов (только для админов)"
+)
+
+class ParseStates(StatesGroup):
+    waiting_url = State()  # Пользователь должен прислать URL категории
+
 class BotHandlers:
     def __init__(self, dp: Dispatcher, bot, parser, log_service):
         self.dp = dp
         self.bot = bot
         self.parser = parser
         self.log_service = log_service
-        self.waiting_for_url = {}
 
-        # Регистрация обработчиков
-        self.dp.register_message_handler(self.start, commands=["start"], user_id=settings.ADMIN_IDS)
-        self.dp.register_message_handler(self.list_admins, commands=["list"], user_id=settings.ADMIN_IDS)
-        self.dp.register_message_handler(self.manual_parse, commands=["parse"], user_id=settings.ADMIN_IDS)
-        self.dp.register_message_handler(self.handle_text, user_id=settings.ADMIN_IDS)
-        self.dp.register_message_handler(self.unauthorized_access)
+        # Регистрация обработчиков (команды и кнопки меню работают в любом состоянии)
+        self.dp.register_message_handler(self.start, commands=["start"], state="*", user_id=settings.ADMIN_IDS)
+        self.dp.register_message_handler(self.list_admins, commands=["list"], state="*", user_id=settings.ADMIN_IDS)
+        self.dp.register_message_handler(self.manual_parse, commands=["parse"], state="*", user_id=settings.ADMIN_IDS)
+        self.dp.register_message_handler(self.manual_parse, text="Парсить", state="*", user_id=settings.ADMIN_IDS)
+        self.dp.register_message_handler(self.list_admins, text="Список подписчиков", state="*", user_id=settings.ADMIN_IDS)
+        self.dp.register_message_handler(self.cancel_url_input, text="Отмена", state=ParseStates.waiting_url, user_id=settings.ADMIN_IDS)
+        self.dp.register_message_handler(self.handle_url, state=ParseStates.waiting_url, user_id=settings.ADMIN_IDS)
+        self.dp.register_message_handler(self.unauthorized_access, lambda message: message.from_user.id not in settings.ADMIN_IDS)
 
     def get_main_menu(self, user_id: int) -> ReplyKeyboardMarkup:
         """Создание главного меню"""
@@ -35,24 +52,16 @@ class BotHandlers:
     async def start(self, message: types.Message):
         """Обработчик команды /start"""
         user_id = message.from_user.id
-        welcome_text = (
-            "🛍️ *Wilberries Parser Frequency Bot*\n\n"
-            "Этот бот анализирует категории Wildberries и предоставляет статистику частоты поиска товаров.\n\n"
-            "Доступные команды:\n"
-            "/parse - Запросить анализ категории\n"
-            "/list - Показать список админов (только для админов)"
-        )
-        await message.answer(welcome_text, parse_mode="Markdown", reply_markup=self.get_main_menu(user_id))
+        await message.answer(WELCOME_TEXT, parse_mode="Markdown", reply_markup=self.get_main_menu(user_id))
 
     async def list_admins(self, message: types.Message):
         """Показать список админов"""
-        admins = "\n".join([f"- {admin_id}" for admin_id in settings.ADMIN_IDS])
+        admins = "\n".join(f"- {admin_id}" for admin_id in settings.ADMIN_IDS_LIST)
         await message.answer(f"📋 Список админов:\n{admins}", reply_markup=self.get_main_menu(message.from_user.id))
 
     async def manual_parse(self, message: types.Message):
         """Ручной запрос парсинга"""
-        user_id = message.from_user.id
-        self.waiting_for_url[user_id] = 'manual'
+        await ParseStates.waiting_url.set()
         await message.answer(
             "🔗 Пожалуйста, отправьте URL категории Wildberries в формате:\n"
             "https://www.wildberries.ru/catalog/<category>/<subcategory>/<subsubcategory>\n"
@@ -61,59 +70,50 @@ class BotHandlers:
             reply_markup=self.get_url_input_menu()
         )
 
-    async def handle_text(self, message: types.Message):
-        """Обработка текстовых сообщений"""
+    async def cancel_url_input(self, message: types.Message, state: FSMContext):
+        """Отмена ввода URL"""
+        await state.finish()
+        await message.answer(
+            "❌ Ввод URL отменён.",
+            parse_mode="Markdown",
+            reply_markup=self.get_main_menu(message.from_user.id)
+        )
+
+    async def handle_url(self, message: types.Message, state: FSMContext):
+        """Обработка URL категории"""
         user_id = message.from_user.id
-        text = message.text.strip()
+        url = message.text.strip()
 
-        if text == "Парсить":
-            await self.manual_parse(message)
-            return
-        elif text == "Список подписчиков":
-            await self.list_admins(message)
-            return
-        elif text == "Отмена" and user_id in self.waiting_for_url:
-            del self.waiting_for_url[user_id]
+        if not URL_PATTERN.match(url):
             await message.answer(
-                "❌ Ввод URL отменён.",
+                "❌ Ошибка: URL некорректен. Пожалуйста, используйте формат:\n"
+                "https://www.wildberries.ru/catalog/<category>/<subcategory>/<subsubcategory>\n"
+                "Например: https://www.wildberries.ru/catalog/dom-i-dacha/vannaya/aksessuary\n\n"
+                "Попробуйте снова или нажмите 'Отмена'.",
                 parse_mode="Markdown",
-                reply_markup=self.get_main_menu(user_id)
+                reply_markup=self.get_url_input_menu()
             )
             return
 
-        if user_id in self.waiting_for_url:
-            url = text
-            url_pattern = r'^https://www\.wildberries\.ru/catalog/[\w-]+/[\w-]+/[\w-]+$'
-            if not re.match(url_pattern, url):
-                await message.answer(
-                    "❌ Ошибка: URL некорректен. Пожалуйста, используйте формат:\n"
-                    "https://www.wildberries.ru/catalog/<category>/<subcategory>/<subsubcategory>\n"
-                    "Например: https://www.wildberries.ru/catalog/dom-i-dacha/vannaya/aksessuary\n\n"
-                    "Попробуйте снова или нажмите 'Отмена'.",
-                    parse_mode="Markdown",
-                    reply_markup=self.get_url_input_menu()
-                )
-                return
-
-            await message.answer("🔄 Запускаю анализ категории...", reply_markup=self.get_url_input_menu())
-            success = await self.parser.parse_category(url, user_id)
-            await self.log_service.clear_log_messages(user_id)
-            if success:
-                del self.waiting_for_url[user_id]
-                await message.answer(
-                    "✅ Парсинг завершён.",
-                    parse_mode="Markdown",
-                    reply_markup=self.get_main_menu(user_id)
-                )
-            else:
-                await message.answer(
-                    "❌ Ошибка: Категория не найдена или URL некорректен. Пожалуйста, используйте формат:\n"
-                    "https://www.wildberries.ru/catalog/<category>/<subcategory>/<subsubcategory>\n"
-                    "Например: https://www.wildberries.ru/catalog/dom-i-dacha/vannaya/aksessuary\n\n"
-                    "Попробуйте снова или нажмите 'Отмена'.",
-                    parse_mode="Markdown",
-                    reply_markup=self.get_url_input_menu()
-                )
+        await message.answer("🔄 Запускаю анализ категории...", reply_markup=self.get_url_input_menu())
+        success = await self.parser.parse_category(url, user_id)
+        await self.log_service.clear_log_messages(user_id)
+        if success:
+            await state.finish()
+            await message.answer(
+                "✅ Парсинг завершён.",
+                parse_mode="Markdown",
+                reply_markup=self.get_main_menu(user_id)
+            )
+        else:
+            await message.answer(
+                "❌ Ошибка: Категория не найдена или URL некорректен. Пожалуйста, используйте формат:\n"
+                "https://www.wildberries.ru/catalog/<category>/<subcategory>/<subsubcategory>\n"
+                "Например: https://www.wildberries.ru/catalog/dom-i-dacha/vannaya/aksessuary\n\n"
+                "Попробуйте снова или нажмите 'Отмена'.",
+                parse_mode="Markdown",
+                reply_markup=self.get_url_input_menu()
+            )
 
     async def unauthorized_access(self, message: types.Message):
         """Обработчик для неавторизованных пользователей"""
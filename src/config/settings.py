@@ -1,18 +1,39 @@
 import os
 from dotenv import load_dotenv
+from pytz import timezone
 
 load_dotenv()
 
 class Settings:
     TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-    ADMIN_IDS = [int(id_) for id_ in os.getenv("ADMIN_ID").split(",")]
+    ADMIN_IDS_LIST = list(dict.fromkeys(int(id_) for id_ in os.getenv("ADMIN_ID").split(",")))  # Без дубликатов, порядок сохраняется
+    ADMIN_IDS = frozenset(ADMIN_IDS_LIST)  # Для быстрых проверок доступа
     OUTPUT_DIR = "output"
     LOG_DIR = "logs"
     EVIRMA_JSON_PATH = os.path.join(OUTPUT_DIR, "evirma.json")
+    CATALOG_CACHE_PATH = os.path.join(OUTPUT_DIR, "wb_catalog_index.json")
     WB_CATALOG_URL = "https://static-basket-01.wbbasket.ru/vol0/data/main-menu-ru-ru-v3.json"
     EVIRMA_API_URL = "https://evirma.ru/api/v1/keyword/list"
+    CATALOG_TTL = 3600  # Секунды, через которые каталог WB загружается заново
+    CATALOG_RETRY_INTERVAL = 60  # Секунды до новой попытки, если обновить каталог не удалось
     MAX_PAGES = 2
     PRODUCTS_PER_PAGE = 100
-    FILE_DELETE_DELAY = 15  # Секунды
+    PAGE_CONCURRENCY = 10  # Максимум одновременных запросов страниц WB
+    WB_RATE = 5  # Запросов страниц WB в секунду
+    WB_TARGET_LATENCY = 1.0  # Секунды; при большей средней задержке параллельность снижается
+    WB_RETRIES = 3  # Повторов страницы WB после ответа 429
+    WB_BACKOFF_BASE = 1.0  # Секунды; задержка перед первым повтором без Retry-After
+    WB_BACKOFF_CAP = 30  # Секунды; максимальная задержка между повторами
+    WB_BACKOFF_JITTER = 0.5  # Доля случайной добавки к задержке
+    EVIRMA_RATE = 1  # Запросов в секунду к Evirma API
+    EVIRMA_BATCH_SIZE = 500  # Ключевых слов в одном запросе к Evirma API
+    TELEGRAM_GLOBAL_RATE = 30  # Сообщений в секунду на бота
+    TELEGRAM_CHAT_RATE = 1  # Сообщений в секунду на чат
+    TELEGRAM_RETRIES = 3  # Повторов запроса к Telegram после RetryAfter
+    LOG_FLUSH_DELAY = 0.5  # Секунды между правками сообщения с логами
+    LOG_MAX_BYTES = 10_000_000  # Размер файла лога до ротации
+    LOG_BACKUP_COUNT = 5  # Сколько старых файлов лога хранить
+    LOG_MAX_LINES = 10  # Строк в сообщении с логами (старые вытесняются)
+    TIMEZONE = timezone("Europe/Moscow")  # Часовой пояс дат в отчётах
 
 settings = Settings()
\ No newline at end of file
@@ -1,5 +1,6 @@
-import requests
-from typing import List, Dict, Optional
+import orjson
+from aiolimiter import AsyncLimiter
+from typing import List, Dict
 from src.config.settings import settings
 
 class EvirmaClient:
@@ -9,57 +10,43 @@ class EvirmaClient:
         'Content-Type': 'application/json'
     }
 
-    def __init__(self, file_service):
+    def __init__(self, file_service, http_service):
         self.file_service = file_service
+        self.http_service = http_service
+        self.limiter = AsyncLimiter(settings.EVIRMA_RATE, 1)
 
-    async def query_evirma_api(self, keywords: List[str]) -> Optional[Dict]:
-        """Запрос к Evirma API для анализа ключевых слов"""
+    async def query_evirma_api(self, keywords: List[str]) -> Dict:
+        """Запрос к Evirma API для анализа ключевых слов (возвращает словарь keywords как есть)"""
         payload = {
             "keywords": keywords,
             "an": False
         }
         
-        response = requests.post(settings.EVIRMA_API_URL, json=payload, headers=self.HEADERS)
-        response.raise_for_status()
+        session = await self.http_service.get_session()
+        async with self.limiter, session.post(settings.EVIRMA_API_URL, json=payload, headers=self.HEADERS) as response:
+            response.raise_for_status()
+            response_data = orjson.loads(await response.read())
         
-        response_data = response.json()
-        filtered_data = {
-            "data": {
-                "keywords": {
-                    keyword: data for keyword, data in response_data.get("data", {}).get("keywords", {}).items()
-                    if data.get("cluster") is not None
-                }
-            }
-        }
-        
-        if not filtered_data["data"]["keywords"]:
-            return None
-        
-        # await self.file_service.save_to_json(filtered_data)
-        return filtered_data
+        # await self.file_service.save_to_json(response_data)
+        return response_data.get("data", {}).get("keywords", {})
 
-    async def parse_evirma_response(self, evirma_data: Dict) -> List[Dict]:
-        """Анализ ответа от Evirma API"""
-        parsed_data = []
-        if not isinstance(evirma_data, dict):
-            return parsed_data
-        
-        data = evirma_data.get('data')
-        if data is None:
-            return parsed_data
-        
-        keywords = data.get('keywords')
-        if not isinstance(keywords, dict):
-            return parsed_data
-        
-        for keyword, keyword_data in keywords.items():
-            if not isinstance(keyword_data, dict):
-                continue
-            cluster = keyword_data.get('cluster', {})
-            parsed_data.append({
+    async def query_evirma_batches(self, keywords: List[str]) -> List[Dict]:
+        """Анализ названий со всех страниц пачками по EVIRMA_BATCH_SIZE вместо запроса на каждую страницу"""
+        keywords = list(dict.fromkeys(keywords))
+        results = []
+        for start in range(0, len(keywords), settings.EVIRMA_BATCH_SIZE):
+            batch = keywords[start:start + settings.EVIRMA_BATCH_SIZE]
+            results.extend(await self.parse_evirma_response(await self.query_evirma_api(batch)))
+        return results
+
+    async def parse_evirma_response(self, keywords: Dict) -> List[Dict]:
+        """Анализ ответа от Evirma API (ключевые слова без кластера пропускаются)"""
+        return [
+            {
                 'Название': keyword,
                 'Количество товара': cluster.get('product_count', 0),
                 'Частота товара': cluster.get('freq_syn', {}).get('monthly', 0)
-            })
-        
-        return parsed_data
\ No newline at end of file
+            }
+            for keyword, keyword_data in (keywords or {}).items()
+            if (cluster := keyword_data.get('cluster')) is not None
+        ]
\ No newline at end of file
@@ -1,7 +1,13 @@
-import requests
+import aiofiles
+import aiohttp
+import orjson
+import random
 from typing import List, Dict, Optional
 import time
+import datetime
+from urllib.parse import urlsplit
 from src.config.settings import settings
+from src.services.adaptive_limiter import AdaptiveLimiter
 import asyncio
 
 class WildberriesParser:
@@ -11,57 +17,102 @@ class WildberriesParser:
         'Content-Type': 'application/json'
     }
 
-    def __init__(self, file_service, evirma_client, log_service):
+    def __init__(self, file_service, evirma_client, log_service, http_service):
         self.file_service = file_service
         self.evirma_client = evirma_client
         self.log_service = log_service
-        self.catalog_data = None
+        self.http_service = http_service
+        self.category_index = None  # URL категории -> данные категории
+        self.catalog_loaded_at = 0.0
+        self.catalog_etag = None  # ETag каталога, по которому построен category_index
         self.results = []
+        self._parse_lock = asyncio.Lock()
+        self.wb_limiter = AdaptiveLimiter(settings.WB_RATE, settings.PAGE_CONCURRENCY, settings.WB_TARGET_LATENCY)
+        self._results_cache = {}  # url -> (ключ часа UTC, категория, результаты)
 
-    async def fetch_wb_catalog(self) -> Dict:
-        """Получение каталога Wildberries"""
+    async def fetch_wb_catalog(self, etag: Optional[str] = None) -> tuple[Optional[Dict], Optional[str]]:
+        """Получение каталога Wildberries (None, если каталог не изменился с ETag)"""
+        headers = {**self.HEADERS, 'If-None-Match': etag} if etag else self.HEADERS
         try:
-            response = requests.get(settings.WB_CATALOG_URL, headers=self.HEADERS)
-            response.raise_for_status()
-            return response.json()
-        except requests.RequestException as e:
+            session = await self.http_service.get_session()
+            async with session.get(settings.WB_CATALOG_URL, headers=headers) as response:
+                if response.status == 304:
+                    return None, etag
+                response.raise_for_status()
+                return orjson.loads(await response.read()), response.headers.get('ETag')
+        except aiohttp.ClientError as e:
             await self.log_service.log_to_file(f"Error fetching WB catalog: {e}", "error")
             raise
 
-    async def extract_category_data(self, catalog: Dict) -> List[Dict]:
-        """Извлечение данных категорий"""
-        categories = []
-        def process_node(node):
-            if isinstance(node, dict):
-                category = {
+    async def read_catalog_cache(self) -> Optional[Dict]:
+        """Чтение индекса категорий и его ETag с диска"""
+        try:
+            async with aiofiles.open(settings.CATALOG_CACHE_PATH, 'rb') as f:
+                return orjson.loads(await f.read())
+        except (OSError, orjson.JSONDecodeError):
+            return None
+
+    async def write_catalog_cache(self, etag: str, category_index: Dict[str, Dict]):
+        """Сохранение индекса категорий вместе с ETag каталога"""
+        try:
+            async with aiofiles.open(settings.CATALOG_CACHE_PATH, 'wb') as f:
+                await f.write(orjson.dumps({'etag': etag, 'index': category_index}))
+        except OSError as e:
+            await self.log_service.log_to_file(f"Error saving catalog cache: {e}", "error")
+
+    async def build_category_index(self, catalog: Dict) -> Dict[str, Dict]:
+        """Индекс категорий по URL за один обход дерева (явный стек вместо рекурсии)"""
+        category_index = {}
+        stack = [catalog]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, list):
+                stack.extend(reversed(node))  # Сохраняем порядок обхода: при дублях URL побеждает первая категория
+            elif isinstance(node, dict):
+                category_index.setdefault(node['url'], {
                     'name': node['name'],
                     'shard': node.get('shard'),
                     'url': node['url'],
                     'query': node.get('query')
-                }
-                categories.append(category)
-                if 'childs' in node:
-                    for child in node['childs']:
-                        process_node(child)
-            elif isinstance(node, list):
-                for item in node:
-                    process_node(item)
-        process_node(catalog)
-        return categories
+                })
+                stack.extend(reversed(node.get('childs', [])))
+        return category_index
+
+    async def load_category_index(self) -> Dict[str, Dict]:
+        """Индекс категорий по URL (раз в CATALOG_TTL секунд каталог проверяется по ETag, индекс хранится на диске)"""
+        if self.category_index is None or time.time() - self.catalog_loaded_at > settings.CATALOG_TTL:
+            if self.category_index is None:
+                cached = await self.read_catalog_cache()
+                if cached:
+                    self.category_index, self.catalog_etag = cached['index'], cached['etag']
+            
+            try:
+                catalog, etag = await self.fetch_wb_catalog(self.catalog_etag)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if self.category_index is None:
+                    raise
+                # Каталог недоступен: работаем с уже загруженным индексом, повтор не раньше чем через CATALOG_RETRY_INTERVAL
+                self.catalog_loaded_at = time.time() - settings.CATALOG_TTL + settings.CATALOG_RETRY_INTERVAL
+                await self.log_service.log_to_file("WB catalog unavailable, using stale category index", "warning")
+                return self.category_index
+            if catalog is not None:
+                self.category_index = await self.build_category_index(catalog)
+                self.catalog_etag = etag
+                if etag:
+                    await self.write_catalog_cache(etag, self.category_index)
+            self.catalog_loaded_at = time.time()
+        return self.category_index
 
     async def find_category_by_url(self, url: str) -> Optional[Dict]:
         """Поиск категории по URL"""
-        if self.catalog_data is None:
-            self.catalog_data = await self.fetch_wb_catalog()
-        
-        categories = await self.extract_category_data(self.catalog_data)
-        relative_url = url.split('https://www.wildberries.ru')[-1]
+        category_index = await self.load_category_index()
+        parts = urlsplit(url)
+        relative_url = parts.path + ('?' + parts.query if parts.query else '')
         
-        for category in categories:
-            if category['url'] == relative_url:
-                await self.log_service.log_to_file(f"Found category: {category['name']}", "info")
-                return category
-        return None
+        category = category_index.get(relative_url)
+        if category:
+            await self.log_service.log_to_file(f"Found category: {category['name']}", "info")
+        return category
 
     async def scrape_wb_page(self, page: int, category: Dict) -> tuple[Dict, str]:
         """Парсинг страницы товаров Wildberries"""
@@ -71,27 +122,76 @@ class WildberriesParser:
             f'&sort=popular&spp=0&{category["query"]}'
         )
         
-        response = requests.get(url, headers=self.HEADERS)
-        response.raise_for_status()
+        session = await self.http_service.get_session()
+        async with session.get(url, headers=self.HEADERS) as response:
+            response.raise_for_status()
+            data = orjson.loads(await response.read())
         
-        data = response.json()
         products_count = len(data.get("data", {}).get("products", []))
         log_message = f"Страница {page}: получено {products_count} товаров"
         await self.log_service.log_to_file(log_message, "info")
         return data, log_message
 
+    async def scrape_wb_page_with_retry(self, page: int, category: Dict) -> tuple[Dict, str]:
+        """Парсинг страницы с повтором при 429: ждём Retry-After или экспоненциальную задержку с джиттером"""
+        for attempt in range(settings.WB_RETRIES + 1):
+            try:
+                async with self.wb_limiter.slot():
+                    return await self.scrape_wb_page(page=page, category=category)
+            except aiohttp.ClientResponseError as e:
+                if e.status != 429 or attempt == settings.WB_RETRIES:
+                    raise
+                retry_after = e.headers.get("Retry-After") if e.headers else None
+                if retry_after and retry_after.isdigit():
+                    delay = float(retry_after)
+                else:
+                    backoff = settings.WB_BACKOFF_BASE * 2 ** attempt * (1 + random.random() * settings.WB_BACKOFF_JITTER)
+                    delay = min(settings.WB_BACKOFF_CAP, backoff)
+                await self.log_service.log_to_file(f"Page {page}: 429, retry {attempt + 1} in {delay:.1f}s", "warning")
+                await asyncio.sleep(delay)
+
+    async def scrape_products(self, page: int, category: Dict, user_id: int) -> List[str]:
+        """Парсинг одной страницы: названия товаров"""
+        wb_data, log_message = await self.scrape_wb_page_with_retry(page, category)
+        await self.log_service.update_log_message(user_id, log_message)
+        return await self.process_products(wb_data)
+
     async def process_products(self, products_data: Dict) -> List[str]:
-        """Извлечение названий товаров"""
-        return [
+        """Извлечение названий товаров (без повторов, порядок сохраняется)"""
+        return list(dict.fromkeys(
             product['name']
             for product in products_data.get('data', {}).get('products', [])
             if 'name' in product
-        ]
+        ))
 
     async def parse_category(self, url: str, user_id: int) -> bool:
+        """Парсинг категории с повторным использованием результатов в пределах часа"""
+        cache_key = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d%H")
+        async with self._parse_lock:
+            cached = self._results_cache.get(url)
+            if cached is None or cached[0] != cache_key:
+                return await self._parse_category(url, user_id, cache_key)
+
+            _, category, results = cached
+            await self.log_service.log_to_file(f"Using cached results for {category['name']}", "info")
+            await self.send_report(category, results, user_id, "Cached results sent")
+            return True
+
+    async def send_report(self, category: Optional[Dict], results: List[Dict], user_id: int, summary: str):
+        """Формирование и отправка Excel-отчёта по категории"""
+        if category is None or not results:
+            return
+        filename = f"{category['name']}_analysis_{int(time.time())}"
+        report = await self.file_service.build_excel(results)
+        if report:
+            await self.file_service.send_excel_to_user(report, filename, user_id)
+            await self.log_service.log_to_file(f"{summary}. Saved {len(results)} items", "info")
+
+    async def _parse_category(self, url: str, user_id: int, cache_key: str) -> bool:
         """Основной метод парсинга категории"""
         start_time = time.time()
         self.results = []
+        category = None  # Нужна в except, даже если каталог не загрузился
         
         try:
             category = await self.find_category_by_url(url)
@@ -99,77 +199,51 @@ class WildberriesParser:
                 await self.log_service.log_to_file("Category not found. Check the URL.", "warning")
                 return False
             
-            for page in range(1, settings.MAX_PAGES + 1):
-                wb_data, log_message = await self.scrape_wb_page(page=page, category=category)
-                await self.log_service.update_log_message(user_id, log_message)
-                
-                products = await self.process_products(wb_data)
+            # Страницы запрашиваются параллельно, темп и число одновременных запросов задаёт wb_limiter
+            pages = await asyncio.gather(
+                *(self.scrape_products(page, category, user_id) for page in range(1, settings.MAX_PAGES + 1)),
+                return_exceptions=True
+            )
+            keywords = []
+            page_error = None
+            for page, products in enumerate(pages, start=1):
+                if isinstance(products, Exception):
+                    page_error = products
+                    break
                 if not products:
                     await self.log_service.log_to_file(f"Page {page}: no products found, stopping parsing.", "info")
-                    if self.results:
-                        filename = f"{category['name']}_analysis_{int(time.time())}"
-                        file_path = await self.file_service.save_to_excel(self.results, filename)
-                        if file_path:
-                            await self.file_service.send_excel_to_user(file_path, filename, user_id)
-                            await self.log_service.log_to_file(f"Parsing finished: no more products. Saved {len(self.results)} items", "info")
-                    break
-                
-                evirma_response = await self.evirma_client.query_evirma_api(products)
-                if evirma_response is None:
-                    if self.results:
-                        filename = f"{category['name']}_analysis_{int(time.time())}"
-                        file_path = await self.file_service.save_to_excel(self.results, filename)
-                        if file_path:
-                            await self.file_service.send_excel_to_user(file_path, filename, user_id)
-                            await self.log_service.log_to_file(f"Parsing finished: no more products. Saved {len(self.results)} items", "info")
-                    else:
-                        await self.log_service.log_to_file("No products found matching criteria.", "info")
                     break
-                
-                page_results = await self.evirma_client.parse_evirma_response(evirma_response)
-                self.results.extend(page_results)
-                
-                await asyncio.sleep(1)
+                keywords.extend(products)
+            
+            # Названия со всех страниц уходят в Evirma пачками, а не запросом на каждую страницу
+            self.results.extend(await self.evirma_client.query_evirma_batches(keywords))
+            if page_error:
+                raise page_error
             
             if self.results:
-                filename = f"{category['name']}_analysis_{int(time.time())}"
-                file_path = await self.file_service.save_to_excel(self.results, filename)
-                if file_path:
-                    await self.file_service.send_excel_to_user(file_path, filename, user_id)
-                    await self.log_service.log_to_file(f"Parsing finished: no more products. Saved {len(self.results)} items", "info")
+                self._results_cache = {
+                    cached_url: cached for cached_url, cached in self._results_cache.items()
+                    if cached[0] == cache_key
+                }
+                self._results_cache[url] = (cache_key, category, list(self.results))
+                await self.send_report(category, self.results, user_id, "Parsing finished: no more products")
             else:
                 await self.log_service.log_to_file("No products found matching criteria.", "info")
             
             return True
                 
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 429:
+        except aiohttp.ClientResponseError as e:
+            if e.status == 429:
                 await self.log_service.log_to_file("Maximum products parsed (429 error).", "info")
-                if self.results:
-                    filename = f"{category['name']}_analysis_{int(time.time())}"
-                    file_path = await self.file_service.save_to_excel(self.results, filename)
-                    if file_path:
-                        await self.file_service.send_excel_to_user(file_path, filename, user_id)
-                        await self.log_service.log_to_file(f"Parsing finished: max products parsed. Saved {len(self.results)} items", "info")
-                return True
+                await self.send_report(category, self.results, user_id, "Parsing finished: max products parsed")
             else:
                 await self.log_service.log_to_file(f"Parsing error: {str(e)}", "error")
-                if self.results:
-                    filename = f"{category['name']}_analysis_{int(time.time())}"
-                    file_path = await self.file_service.save_to_excel(self.results, filename)
-                    if file_path:
-                        await self.file_service.send_excel_to_user(file_path, filename, user_id)
-                        await self.log_service.log_to_file(f"Parsing finished due to error. Saved {len(self.results)} items", "info")
-                return True
+                await self.send_report(category, self.results, user_id, "Parsing finished due to error")
+            return True
         except Exception as e:
             await self.log_service.log_to_file(f"Parsing error: {str(e)}", "error")
-            if self.results:
-                filename = f"{category['name']}_analysis_{int(time.time())}"
-                file_path = await self.file_service.save_to_excel(self.results, filename)
-                if file_path:
-                    await self.file_service.send_excel_to_user(file_path, filename, user_id)
-                    await self.log_service.log_to_file(f"Parsing finished due to error. Saved {len(self.results)} items", "info")
+            await self.send_report(category, self.results, user_id, "Parsing finished due to error")
             return True
         finally:
             elapsed_time = time.time() - start_time
-            await self.log_service.log_to_file(f"Total parsing time: {elapsed_time:.2f} seconds", "info")
\ No newline at end of file
+            await self.log_service.log_to_file(f"Total parsing time: {elapsed_time:.2f} seconds", "info")
@@ -0,0 +1,74 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+import aiohttp
+
+class AdaptiveLimiter:
+    """Ограничение запросов к WB: token bucket по частоте и AIMD по числу одновременных запросов"""
+
+    WINDOW = 20  # Последних замеров задержки для скользящего среднего
+
+    def __init__(self, rate: float, max_concurrency: int, target_latency: float):
+        self.rate = rate
+        self.tokens = rate
+        self.last_refill = time.monotonic()
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.target_latency = target_latency
+        self.latencies = deque(maxlen=self.WINDOW)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self._slots = asyncio.Condition()
+
+    async def _acquire_token(self):
+        """Ожидание токена (и конца паузы после 429)"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def _on_success(self, latency: float):
+        """Аддитивное увеличение лимита, пока средняя задержка в норме"""
+        self.latencies.append(latency)
+        if sum(self.latencies) / len(self.latencies) <= self.target_latency:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 0.5)
+        else:
+            self.concurrency = max(1.0, self.concurrency * 0.5)
+
+    def _on_throttle(self, retry_after: Optional[str]):
+        """Мультипликативное уменьшение лимита и пауза по Retry-After"""
+        self.concurrency = max(1.0, self.concurrency * 0.5)
+        if retry_after and retry_after.isdigit():
+            self.paused_until = max(self.paused_until, time.monotonic() + int(retry_after))
+
+    @asynccontextmanager
+    async def slot(self):
+        """Слот для одного запроса; задержка и ответы 429/5xx подстраивают лимиты"""
+        async with self._slots:
+            await self._slots.wait_for(lambda: self.in_flight < int(self.concurrency))
+            self.in_flight += 1
+        try:
+            await self._acquire_token()
+            start = time.monotonic()
+            try:
+                yield
+            except aiohttp.ClientResponseError as e:
+                if e.status == 429 or e.status >= 500:
+                    self._on_throttle(e.headers.get("Retry-After") if e.headers else None)
+                raise
+            self._on_success(time.monotonic() - start)
+        finally:
+            async with self._slots:
+                self.in_flight -= 1
+                self._slots.notify_all()
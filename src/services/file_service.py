@@ -1,78 +1,76 @@
-import os
-import json
 import asyncio
-import pandas as pd
+import io
+import os
+import orjson
+import xlsxwriter
 from aiogram import Bot
 from aiogram import types
 import datetime
 from src.config.settings import settings
 
 class FileService:
-    def __init__(self, bot: Bot, log_service):
+    def __init__(self, bot: Bot, log_service, rate_limiter):
         self.bot = bot
         self.log_service = log_service
+        self.rate_limiter = rate_limiter
         os.makedirs(settings.OUTPUT_DIR, exist_ok=True)
 
+    @staticmethod
+    def _write_json(data: dict, path: str):
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+
     async def save_to_json(self, data: dict, path: str = settings.EVIRMA_JSON_PATH):
-        """Сохранение данных в JSON"""
+        """Сохранение данных в JSON (запись идёт в отдельном потоке)"""
         try:
-            with open(path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            await asyncio.to_thread(self._write_json, data, path)
             await self.log_service.log_to_file(f"Saved JSON to {path}", "info")
         except Exception as e:
             await self.log_service.log_to_file(f"Error saving JSON: {e}", "error")
 
-    async def save_to_excel(self, data: list, filename: str):
-        """Сохранение данных в Excel"""
+    @staticmethod
+    def _build_excel_sync(data: list) -> bytes:
+        buffer = io.BytesIO()
+        # constant_memory: строки пишутся по порядку и сразу сбрасываются, без промежуточного DataFrame
+        workbook = xlsxwriter.Workbook(buffer, {'constant_memory': True})
+        worksheet = workbook.add_worksheet('data')
+        worksheet.set_column('A:A', 50)
+        worksheet.set_column('B:B', 25)
+        worksheet.set_column('C:C', 25)
+        columns = list(data[0])
+        header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center'})
+        worksheet.write_row(0, 0, columns, header_format)
+        for row, item in enumerate(data, start=1):
+            worksheet.write_row(row, 0, [item.get(column) for column in columns])
+        workbook.close()
+        return buffer.getvalue()
+
+    async def build_excel(self, data: list):
+        """Формирование Excel-отчёта в памяти (в отдельном потоке, чтобы не блокировать event loop)"""
         if not data:
             await self.log_service.log_to_file("No data to save to Excel", "warning")
             return None
 
-        df = pd.DataFrame(data)
-        file_path = os.path.join(settings.OUTPUT_DIR, f'{filename}.xlsx')
         try:
-            with pd.ExcelWriter(file_path, engine='xlsxwriter') as writer:
-                df.to_excel(writer, sheet_name='data', index=False)
-                worksheet = writer.sheets['data']
-                worksheet.set_column('A:A', 50)
-                worksheet.set_column('B:B', 25)
-                worksheet.set_column('C:C', 25)
-            await self.log_service.log_to_file(f"Saved Excel to {file_path}", "info")
-            return file_path
+            report = await asyncio.to_thread(self._build_excel_sync, data)
+            await self.log_service.log_to_file(f"Built Excel report ({len(report)} bytes)", "info")
+            return report
         except Exception as e:
-            await self.log_service.log_to_file(f"Error saving Excel: {e}", "error")
+            await self.log_service.log_to_file(f"Error building Excel: {e}", "error")
             return None
 
-    async def send_excel_to_user(self, file_path: str, filename: str, user_id: int):
-        """Отправка Excel-файла пользователю с последующим удалением"""
-        if not os.path.exists(file_path):
-            await self.bot.send_message(user_id, f"❌ Файл отчета {file_path} не найден!", parse_mode="Markdown")
-            await self.log_service.log_to_file(f"Excel file not found: {file_path}", "error")
-            return
-
-        today = datetime.datetime.now().strftime("%d.%m.%Y")
+    async def send_excel_to_user(self, report: bytes, filename: str, user_id: int):
+        """Отправка Excel-отчёта пользователю без записи на диск"""
+        today = datetime.datetime.now(settings.TIMEZONE).strftime("%d.%m.%Y")
         caption = f"📊 *Анализ категории Wildberries* ({today})"
         try:
-            with open(file_path, "rb") as file:
-                await self.bot.send_document(
-                    user_id,
-                    types.InputFile(file, f'{filename}.xlsx'),
-                    caption=caption,
-                    parse_mode="Markdown"
-                )
-            await self.log_service.log_to_file(f"Excel report sent to user {user_id}: {file_path}", "info")
-            asyncio.create_task(self.delete_file_after_delay(file_path))
+            # Файл создаётся заново на каждую попытку: после выгрузки поток уже прочитан
+            await self.rate_limiter.call(user_id, lambda: self.bot.send_document(
+                user_id,
+                types.InputFile(io.BytesIO(report), f'{filename}.xlsx'),
+                caption=caption,
+                parse_mode="Markdown"
+            ))
+            await self.log_service.log_to_file(f"Excel report sent to user {user_id}: {filename}.xlsx", "info")
         except Exception as e:
             await self.log_service.log_to_file(f"Failed to send Excel to user {user_id}: {e}", "error")
-
-    async def delete_file_after_delay(self, file_path: str):
-        """Удаление файла через 15 секунд"""
-        await asyncio.sleep(settings.FILE_DELETE_DELAY)
-        try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                await self.log_service.log_to_file(f"File deleted: {file_path}", "info")
-            else:
-                await self.log_service.log_to_file(f"File not found for deletion: {file_path}", "warning")
-        except Exception as e:
-            await self.log_service.log_to_file(f"Failed to delete file {file_path}: {e}", "error")
\ No newline at end of file
@@ -0,0 +1,23 @@
+import aiohttp
+from typing import Optional
+
+class HttpService:
+    TIMEOUT = aiohttp.ClientTimeout(total=30, connect=5)
+
+    def __init__(self):
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Общая HTTP-сессия с пулом keep-alive соединений и кэшем DNS"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=32, limit_per_host=10, ttl_dns_cache=300, keepalive_timeout=60,
+                enable_cleanup_closed=True,  # Закрывать зависшие SSL-соединения
+            )
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.TIMEOUT)
+        return self.session
+
+    async def close(self):
+        """Закрытие HTTP-сессии"""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
@@ -1,24 +1,43 @@
+import asyncio
+import functools
 import logging
 import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from collections import deque
 from aiogram import Bot
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter
 from src.config.settings import settings
 
+LOG_HEADER = "📄 *Логи парсинга:*\n"
+
 class LogService:
-    def __init__(self, bot: Bot):
+    def __init__(self, bot: Bot, rate_limiter):
         self.bot = bot
+        self.rate_limiter = rate_limiter
         os.makedirs(settings.LOG_DIR, exist_ok=True)
         log_file = os.path.join(settings.LOG_DIR, "wb_parser.log")
-        logging.basicConfig(
-            level=logging.INFO,
-            format="%(asctime)s - %(levelname)s - %(message)s",
-            handlers=[
-                logging.FileHandler(log_file, encoding='utf-8'),
-                logging.StreamHandler()
-            ],
+        # Запись в файл и консоль идёт в фоновом потоке, event loop только кладёт записи в очередь
+        formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+        file_handler = RotatingFileHandler(
+            log_file, maxBytes=settings.LOG_MAX_BYTES, backupCount=settings.LOG_BACKUP_COUNT, encoding='utf-8'
         )
+        stream_handler = logging.StreamHandler()
+        for handler in (file_handler, stream_handler):
+            handler.setFormatter(formatter)
+        log_queue = queue.Queue(-1)
+        self.listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+        self.listener.start()
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.setFormatter(logging.Formatter("%(message)s"))  # Итоговое форматирование делают обработчики слушателя
+        logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
         self.logger = logging.getLogger(__name__)
         self.log_messages = {}  # Для хранения message_id и логов в Telegram
 
+    def close(self):
+        """Остановка фонового потока логирования (оставшиеся записи дописываются)"""
+        self.listener.stop()
+
     async def log_to_file(self, message: str, level: str = "info"):
         """Логирование в файл"""
         if level == "info":
@@ -29,27 +48,78 @@ class LogService:
             self.logger.warning(message)
 
     async def update_log_message(self, user_id: int, log_message: str):
-        """Обновление логов в Telegram"""
+        """Обновление логов в Telegram (правки объединяются в одну раз в LOG_FLUSH_DELAY, видны последние LOG_MAX_LINES строк)"""
         await self.log_to_file(log_message, "info")
         if user_id not in self.log_messages:
-            message = await self.bot.send_message(user_id, f"📄 *Логи парсинга:*\n{log_message}", parse_mode="Markdown")
-            self.log_messages[user_id] = {'message_id': message.message_id, 'text': [log_message]}
-        else:
-            current_logs = self.log_messages[user_id]['text']
-            current_logs.append(log_message)
-            new_text = "📄 *Логи парсинга:*\n" + "\n".join(current_logs)  # Ограничение на 10 строк
+            # Запись создаётся до первого await: параллельные вызовы дописывают строки, а не шлют своё сообщение
+            entry = {
+                'message_id': None,
+                'lines': deque([log_message], maxlen=settings.LOG_MAX_LINES),
+                'flush_task': None,
+                'failed': False  # Последняя правка не дошла: при очистке её нужно повторить
+            }
+            self.log_messages[user_id] = entry
             try:
-                await self.bot.edit_message_text(
-                    chat_id=user_id,
-                    message_id=self.log_messages[user_id]['message_id'],
-                    text=new_text,
-                    parse_mode="Markdown"
+                message = await self.rate_limiter.call(
+                    user_id, self.bot.send_message, user_id, LOG_HEADER + log_message, parse_mode="Markdown"
                 )
-                self.log_messages[user_id]['text'] = current_logs
-            except Exception as e:
-                await self.log_to_file(f"Failed to update log message for user {user_id}: {e}", "error")
+            except Exception:
+                self.log_messages.pop(user_id, None)
+                raise
+            entry['message_id'] = message.message_id
+            if len(entry['lines']) > 1 and entry['flush_task'] is None:
+                entry['flush_task'] = asyncio.create_task(self._flush_later(user_id))
+            return
+
+        entry = self.log_messages[user_id]
+        entry['lines'].append(log_message)
+        if entry['message_id'] is not None and entry['flush_task'] is None:
+            entry['flush_task'] = asyncio.create_task(self._flush_later(user_id))
+
+    async def _flush_later(self, user_id: int, delay: float = settings.LOG_FLUSH_DELAY):
+        """Отложенная отправка накопленных логов"""
+        await asyncio.sleep(delay)
+        await self._flush_log_message(user_id)
+
+    async def _flush_log_message(self, user_id: int, wait_retry: bool = False):
+        """Редактирование сообщения с логами в Telegram (на RetryAfter правка переносится, а не теряется)"""
+        entry = self.log_messages.get(user_id)
+        if entry is None or entry['message_id'] is None:
+            return
+        entry['flush_task'] = None
+        edit = functools.partial(
+            self.bot.edit_message_text,
+            chat_id=user_id,
+            message_id=entry['message_id'],
+            text=LOG_HEADER + "\n".join(entry['lines']),
+            parse_mode="Markdown"
+        )
+        try:
+            if wait_retry:
+                await self.rate_limiter.call(user_id, edit)
+            else:
+                async with self.rate_limiter.limit(user_id):
+                    await edit()
+            entry['failed'] = False
+        except MessageNotModified:
+            entry['failed'] = False
+        except RetryAfter as e:
+            entry['failed'] = True
+            if entry['flush_task'] is not None:
+                entry['flush_task'].cancel()
+            entry['flush_task'] = asyncio.create_task(self._flush_later(user_id, e.timeout))
+            await self.log_to_file(f"Log message update for user {user_id} postponed for {e.timeout}s (RetryAfter)", "warning")
+        except Exception as e:
+            entry['failed'] = True
+            await self.log_to_file(f"Failed to update log message for user {user_id}: {e}", "error")
 
     async def clear_log_messages(self, user_id: int):
-        """Очистка логов в Telegram"""
-        if user_id in self.log_messages:
-            del self.log_messages[user_id]
\ No newline at end of file
+        """Очистка логов в Telegram (с отправкой ещё не показанных или не доставленных строк)"""
+        entry = self.log_messages.get(user_id)
+        if entry is None:
+            return
+        if entry['flush_task'] is not None or entry['failed']:
+            if entry['flush_task'] is not None:
+                entry['flush_task'].cancel()
+            await self._flush_log_message(user_id, wait_retry=True)
+        self.log_messages.pop(user_id, None)
@@ -0,0 +1,28 @@
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from aiolimiter import AsyncLimiter
+from aiogram.utils.exceptions import RetryAfter
+from src.config.settings import settings
+
+class RateLimiter:
+    def __init__(self):
+        self.global_limiter = AsyncLimiter(settings.TELEGRAM_GLOBAL_RATE, 1)
+        self.chat_limiters = defaultdict(lambda: AsyncLimiter(settings.TELEGRAM_CHAT_RATE, 1))
+
+    @asynccontextmanager
+    async def limit(self, chat_id: int):
+        """Ожидание свободного слота в лимитах Telegram (общем и для чата)"""
+        async with self.chat_limiters[chat_id], self.global_limiter:
+            yield
+
+    async def call(self, chat_id: int, method, *args, **kwargs):
+        """Вызов метода Bot API в лимитах; на RetryAfter ждём указанное Telegram время и повторяем"""
+        for attempt in range(settings.TELEGRAM_RETRIES + 1):
+            try:
+                async with self.limit(chat_id):
+                    return await method(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == settings.TELEGRAM_RETRIES:
+                    raise
+                await asyncio.sleep(e.timeout)
@@ -1,8 +1,12 @@
+import os
 import requests
-import pandas as pd
+import threading
+import xlsxwriter
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from typing import List, Dict, Optional
 import time
-import os
+import orjson
 
 class WildberriesEvirmaParser:
     """
@@ -19,59 +23,123 @@ class WildberriesEvirmaParser:
     }
     MAX_PAGES = 2  # Максимальное количество страниц для парсинга
     PRODUCTS_PER_PAGE = 100  # Количество товаров на странице
+    PAGE_WORKERS = 8  # Потоков для параллельного парсинга страниц
+    REQUESTS_PER_SECOND = 1  # Темп запросов страниц Wildberries
+    MAX_RETRIES = 3  # Повторов страницы после ответа 429
+    EVIRMA_BATCH_SIZE = 500  # Ключевых слов в одном запросе к Evirma API
+    CATALOG_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'wb_catalog.json')
+    CATALOG_META_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'wb_catalog.meta.json')  # ETag и Last-Modified
     
     def __init__(self):
         """Инициализация парсера"""
-        self.catalog_data = None
+        self.category_index = None  # URL категории -> данные категории
         self.results = []  # Для хранения итоговых данных
+        # Общая сессия: keep-alive соединения переиспользуются всеми потоками
+        self.session = requests.Session()
+        self.session.headers.update(self.HEADERS)
+        self.session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
+        self._rate_lock = threading.Lock()
+        self._next_request_at = 0.0
+    
+    def _throttle(self) -> None:
+        """Ожидание очереди на запрос (не чаще REQUESTS_PER_SECOND, общий лимит для всех потоков)"""
+        with self._rate_lock:
+            now = time.monotonic()
+            wait = self._next_request_at - now
+            self._next_request_at = max(now, self._next_request_at) + 1 / self.REQUESTS_PER_SECOND
+        if wait > 0:
+            time.sleep(wait)
     
     def fetch_wb_catalog(self) -> Dict:
-        """Получение каталога Wildberries"""
+        """Получение каталога Wildberries (копия на диске перепроверяется по ETag/Last-Modified)"""
+        cached, meta = self._read_catalog_cache()
+        headers = {}
+        if cached is not None:  # Без годной копии на диске запрос безусловный
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        
         try:
-            response = requests.get(self.WB_CATALOG_URL, headers=self.HEADERS)
+            response = self.session.get(self.WB_CATALOG_URL, headers=headers)
+            if response.status_code == 304:
+                return cached
             response.raise_for_status()
-            return response.json()
+            self._write_catalog_cache(response.content, {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')
+            })
+            return orjson.loads(response.content)
         except requests.RequestException as e:
             print(f"Ошибка при получении каталога Wildberries: {e}")
             raise
     
+    def _read_catalog_cache(self) -> tuple[Optional[Dict], Dict]:
+        """Чтение сохранённого каталога и его заголовков валидации (битый файл считается отсутствующим)"""
+        try:
+            with open(self.CATALOG_CACHE_PATH, 'rb') as f:
+                cached = orjson.loads(f.read())
+            with open(self.CATALOG_META_PATH, 'rb') as f:
+                meta = orjson.loads(f.read())
+            return cached, meta
+        except (OSError, orjson.JSONDecodeError):
+            return None, {}
+    
+    def _write_catalog_cache(self, content: bytes, meta: Dict) -> None:
+        """Сохранение каталога на диск (только если сервер прислал ETag или Last-Modified)"""
+        if not (meta['etag'] or meta['last_modified']):
+            return
+        try:
+            os.makedirs(os.path.dirname(self.CATALOG_CACHE_PATH), exist_ok=True)
+            # Заголовки пишутся последними: без них копия каталога не используется
+            self._write_atomic(self.CATALOG_CACHE_PATH, content)
+            self._write_atomic(self.CATALOG_META_PATH, orjson.dumps(meta))
+        except OSError as e:
+            print(f"Ошибка при сохранении каталога на диск: {e}")
+    
+    @staticmethod
+    def _write_atomic(path: str, data: bytes) -> None:
+        """Запись файла через временный файл и os.replace, чтобы не оставить его обрезанным"""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    
     def extract_category_data(self, catalog: Dict) -> List[Dict]:
         """Извлечение данных категорий из каталога"""
         categories = []
+        stack = [catalog]
         
-        def process_node(node):
+        # Обход дерева явным стеком; дети кладутся в обратном порядке, чтобы сохранить порядок категорий
+        while stack:
+            node = stack.pop()
             if isinstance(node, dict):
-                category = {
+                categories.append({
                     'name': node['name'],
                     'shard': node.get('shard'),
                     'url': node['url'],
                     'query': node.get('query')
-                }
-                categories.append(category)
-                
-                if 'childs' in node:
-                    for child in node['childs']:
-                        process_node(child)
+                })
+                stack.extend(reversed(node.get('childs', [])))
             elif isinstance(node, list):
-                for item in node:
-                    process_node(item)
+                stack.extend(reversed(node))
         
-        process_node(catalog)
         return categories
     
     def find_category_by_url(self, url: str) -> Optional[Dict]:
         """Поиск категории по URL"""
-        if self.catalog_data is None:
-            self.catalog_data = self.fetch_wb_catalog()
-            
-        categories = self.extract_category_data(self.catalog_data)
-        relative_url = url.split('https://www.wildberries.ru')[-1]
+        if self.category_index is None:
+            # Индекс строится один раз; при дублях URL побеждает первая категория, как при линейном поиске
+            category_index = {}
+            for category in self.extract_category_data(self.fetch_wb_catalog()):
+                category_index.setdefault(category['url'], category)
+            self.category_index = category_index
         
-        for category in categories:
-            if category['url'] == relative_url:
-                print(f"Найдена категория: {category['name']}")
-                return category
-        return None
+        relative_url = url.removeprefix('https://www.wildberries.ru')
+        category = self.category_index.get(relative_url)
+        if category:
+            print(f"Найдена категория: {category['name']}")
+        return category
     
     def scrape_wb_page(self, page: int, category: Dict) -> tuple[Dict, str]:
         """Парсинг страницы товаров Wildberries"""
@@ -81,10 +149,20 @@ class WildberriesEvirmaParser:
             f'&sort=popular&spp=0&{category["query"]}'
         )
         
-        response = requests.get(url, headers=self.HEADERS)
+        for attempt in range(self.MAX_RETRIES + 1):
+            self._throttle()
+            response = self.session.get(url)
+            if response.status_code != 429 or attempt == self.MAX_RETRIES:
+                break
+            # 429: пауза по Retry-After (или экспоненциальная) сдвигает очередь всех потоков
+            retry_after = response.headers.get('Retry-After', '')
+            delay = int(retry_after) if retry_after.isdigit() else 2 ** attempt
+            print(f"Страница {page}: 429 от Wildberries, повтор через {delay} с")
+            with self._rate_lock:
+                self._next_request_at = max(self._next_request_at, time.monotonic() + delay)
         response.raise_for_status()
         
-        data = response.json()
+        data = orjson.loads(response.content)
         products_count = len(data.get("data", {}).get("products", []))
         log_message = f"Страница {page}: получено {products_count} товаров"
         print(log_message)
@@ -97,11 +175,11 @@ class WildberriesEvirmaParser:
             "an": False
         }
         
-        response = requests.post(self.EVIRMA_API_URL, json=payload, headers=self.HEADERS)
+        response = self.session.post(self.EVIRMA_API_URL, json=payload)
         response.raise_for_status()
         
         # Получаем ответ и фильтруем ключевые слова с cluster: null
-        response_data = response.json()
+        response_data = orjson.loads(response.content)
         filtered_data = {
             "data": {
                 "keywords": {
@@ -122,48 +200,51 @@ class WildberriesEvirmaParser:
 
     def save_to_json(self, data: Dict) -> None:
         """Сохранение ответа Evirma API в JSON файл"""
-        import json
-        import os
-        
         try:
-            with open('./evirma.json', 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            with open('./evirma.json', 'wb') as f:
+                f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
         except Exception as e:
             print(f"Ошибка при сохранении в JSON: {e}")
     
+    def query_evirma_batches(self, keywords: List[str]) -> List[Dict]:
+        """Анализ названий со всех страниц пачками по EVIRMA_BATCH_SIZE вместо запроса на каждую страницу"""
+        keywords = list(dict.fromkeys(keywords))
+        results = []
+        for start in range(0, len(keywords), self.EVIRMA_BATCH_SIZE):
+            evirma_response = self.query_evirma_api(keywords[start:start + self.EVIRMA_BATCH_SIZE])
+            if evirma_response is not None:
+                results.extend(self.parse_evirma_response(evirma_response))
+        return results
+    
+    
     def process_products(self, products_data: Dict) -> List[str]:
-        """Извлечение названий товаров из данных Wildberries"""
-        return [
+        """Извлечение названий товаров из данных Wildberries (без повторов, порядок сохраняется)"""
+        return list(dict.fromkeys(
             product['name']
             for product in products_data.get('data', {}).get('products', [])
             if 'name' in product
-        ]
+        ))
     
     def parse_evirma_response(self, evirma_data: Dict) -> List[Dict]:
         """Анализ ответа от Evirma API и извлечение нужных данных"""
-        parsed_data = []
-        
-        if not isinstance(evirma_data, dict):
-            return parsed_data
-        
-        data = evirma_data.get('data')
-        if data is None:
-            return parsed_data
-        
-        keywords = data.get('keywords')
-        if not isinstance(keywords, dict):
-            return parsed_data
+        # Структура ответа проверяется один раз, а не на каждом ключевом слове
+        try:
+            keywords = evirma_data['data']['keywords'].items()
+        except (KeyError, TypeError, AttributeError):
+            return []
         
-        for keyword, keyword_data in keywords.items():
-            if not isinstance(keyword_data, dict):
+        parsed_data = []
+        for keyword, keyword_data in keywords:
+            # Пропускаются только битые записи; отсутствующие счётчики, как и в src/parser/evirma.py, дают 0
+            try:
+                cluster = keyword_data['cluster']
+                parsed_data.append({
+                    'Название': keyword,
+                    'Количество товара': cluster.get('product_count', 0),
+                    'Частота товара': cluster.get('freq_syn', {}).get('monthly', 0)
+                })
+            except (KeyError, TypeError, AttributeError):
                 continue
-                
-            cluster = keyword_data.get('cluster', {})
-            parsed_data.append({
-                'Название': keyword,
-                'Количество товара': cluster.get('product_count', 0),
-                'Частота товара': cluster.get('freq_syn', {}).get('monthly', 0)
-            })
         
         return parsed_data
     
@@ -173,23 +254,26 @@ class WildberriesEvirmaParser:
             print("Нет данных для сохранения!")
             return
         
-        df = pd.DataFrame(self.results)
-        
         # Формируем путь к файлу в корневой директории
         file_path = f'{filename}.xlsx'
         
         try:
-            with pd.ExcelWriter(file_path, engine='xlsxwriter') as writer:
-                df.to_excel(writer, sheet_name='data', index=False)
-                
-                # Get the xlsxwriter workbook and worksheet objects
-                workbook = writer.book
-                worksheet = writer.sheets['data']
-                
-                # Set the column widths
-                worksheet.set_column('A:A', 50)  # Column A width = 50
-                worksheet.set_column('B:B', 25)  # Column B width = 25
-                worksheet.set_column('C:C', 25)  # Column C width = 25
+            # constant_memory: строки сбрасываются на диск по мере записи, без DataFrame в памяти
+            workbook = xlsxwriter.Workbook(file_path, {'constant_memory': True})
+            worksheet = workbook.add_worksheet('data')
+            
+            # Set the column widths
+            worksheet.set_column('A:A', 50)  # Column A width = 50
+            worksheet.set_column('B:B', 25)  # Column B width = 25
+            worksheet.set_column('C:C', 25)  # Column C width = 25
+            
+            # Заголовок в том же стиле, что и у pandas.to_excel
+            columns = list(self.results[0])
+            header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center'})
+            worksheet.write_row(0, 0, columns, header_format)
+            for row, item in enumerate(self.results, start=1):
+                worksheet.write_row(row, 0, [item.get(column) for column in columns])
+            workbook.close()
             
             print(f"Данные сохранены в файл: {file_path}")
         except Exception as e:
@@ -198,6 +282,8 @@ class WildberriesEvirmaParser:
     def parse_category(self, url: str) -> None:
         """Основной метод парсинга категории"""
         start_time = time.time()
+        category = None
+        summary = ": товары закончились"
         
         try:
             # Получаем данные категории
@@ -206,54 +292,47 @@ class WildberriesEvirmaParser:
                 print("Ошибка: Категория не найдена. Проверьте URL.")
                 return
             
-            # Парсим страницы
-            for page in range(1, self.MAX_PAGES + 1):
-                # Получаем данные со страницы Wildberries
-                wb_data, log_message = self.scrape_wb_page(page=page, category=category)
-                
-                products = self.process_products(wb_data)
-                if not products:
-                    print(f"Страница {page}: товары не найдены, завершаем парсинг.")
-                    if self.results:
-                        filename = f"{category['name']}_analysis_{int(time.time())}"
-                        self.save_to_excel(filename)
-                        print(f"\nПарсинг завершён: товары закончились. Сохранено {len(self.results)} товаров")
-                    break
-                
-                # Отправляем запрос в Evirma API
-                evirma_response = self.query_evirma_api(products)
-                
-                # Если API вернул None, сохраняем текущие результаты и завершаем
-                if evirma_response is None:
-                    if self.results:
-                        filename = f"{category['name']}_analysis_{int(time.time())}"
-                        self.save_to_excel(filename)
-                        print(f"\nПарсинг завершён: товары закончились. Сохранено {len(self.results)} товаров")
-                    else:
-                        print("\nТовары не найдены по заданным критериям.")
-                    break
-                
-                # Обрабатываем ответ Evirma
-                page_results = self.parse_evirma_response(evirma_response)
-                self.results.extend(page_results)
-                
-                # Небольшая задержка между запросами
-                time.sleep(1)
+            # Парсим страницы параллельно, темп запросов задаёт _throttle
+            keywords = []
+            page_error = None
+            with ThreadPoolExecutor(max_workers=self.PAGE_WORKERS) as executor:
+                futures = [
+                    executor.submit(self.scrape_wb_page, page=page, category=category)
+                    for page in range(1, self.MAX_PAGES + 1)
+                ]
+                # Страницы разбираем по порядку; после остановки или ошибки оставшиеся страницы не нужны
+                try:
+                    for page, future in enumerate(futures, start=1):
+                        try:
+                            wb_data, _ = future.result()
+                        except Exception as e:
+                            page_error = e
+                            break
+                        products = self.process_products(wb_data)
+                        if not products:
+                            print(f"Страница {page}: товары не найдены, завершаем парсинг.")
+                            break
+                        keywords.extend(products)
+                finally:
+                    for future in futures:
+                        future.cancel()
             
-            # Сохраняем результаты, если они есть
-            if self.results:
-                filename = f"{category['name']}_analysis_{int(time.time())}"
-                self.save_to_excel(filename)
-                print(f"\nПарсинг завершён: товары закончились. Сохранено {len(self.results)} товаров")
-            else:
-                print("\nТовары не найдены по заданным критериям.")
+            # Названия, собранные до остановки, анализируются даже при ошибке на следующей странице
+            self.results.extend(self.query_evirma_batches(keywords))
+            if page_error:
+                raise page_error
                 
         except Exception as e:
             print(f"\nОшибка во время парсинга: {str(e)}")
-            if self.results:
-                filename = f"{category['name']}_analysis_{int(time.time())}"
-                self.save_to_excel(filename)
-                print(f"\nПарсинг завершён из-за ошибки. Сохранено {len(self.results)} товаров")
+            summary = " из-за ошибки"
         finally:
+            # Excel пишется один раз, на любом пути завершения
+            if category:
+                if self.results:
+                    filename = f"{category['name']}_analysis_{int(time.time())}"
+                    self.save_to_excel(filename)
+                    print(f"\nПарсинг завершён{summary}. Сохранено {len(self.results)} товаров")
+                else:
+                    print("\nТовары не найдены по заданным критериям.")
             elapsed_time = time.time() - start_time
-            print(f"\nОбщее время работы: {elapsed_time:.2f} секунд")
\ No newline at end of file
+            print(f"\nОбщее время работы: {elapsed_time:.2f} секунд")